@@ -1,18 +1,29 @@
 import os  # For environment variables and file handling
-import hashlib  # To create a unique fingerprint (hash) for each file
+import io  # To build the COPY data in memory
+from blake3 import blake3  # To create a unique fingerprint (hash) for each file
 import psycopg2  # To connect to a PostgreSQL database
 import psycopg2.extras  # For easier handling of batch inserts
 from psycopg2 import pool  # To manage a pool of database connections
 from pathlib import Path  # Makes working with file paths simpler
+from collections import deque  # Holds the folders still waiting to be scanned
 import psutil  # Helps detect USB drives or mounted devices
 from tqdm import tqdm  # Displays a progress bar during long operations
 import argparse  # Allows users to interact with the script via commands
 import logging  # Keeps a log of what happens during the script's execution
+import queue  # Passes records from the hashing loop to the database thread
+import threading  # Lets the database inserts run while files are being hashed
 from contextlib import (
     contextmanager,
 )  # Simplifies working with resources like database connections
 from dotenv import load_dotenv  # For securely loading environment variables
-from typing import List, Dict, Optional  # For type annotations (helps readability)
+from typing import (
+    List,
+    Optional,
+    Tuple,
+)  # For type annotations (helps readability)
+from concurrent.futures import (
+    ProcessPoolExecutor,
+)  # Spreads the hashing work across all CPU cores
 
 # Step 1: Load environment variables securely from a .env file
 load_dotenv()
@@ -33,23 +44,33 @@ DB_PASSWORD = os.getenv("DB_PASSWORD", "your_database_password")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 
 # Step 4: Define which file extensions to scan for (these are image file types)
-IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".webp", ".dng"}
+IMAGE_EXTENSIONS = frozenset(
+    {".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".webp", ".dng"}
+)
 
 # Step 5: Set the directories to scan for images
+HOME_DIR = Path.home()  # Look up the home folder only once
 SEARCH_DIRS = [
-    Path.home() / "Pictures",  # Default user "Pictures" folder
-    Path.home() / "Documents",  # Add more directories here as needed
+    HOME_DIR / "Pictures",  # Default user "Pictures" folder
+    HOME_DIR / "Documents",  # Add more directories here as needed
 ]
 
 # Step 6: Set directories to exclude from scanning
-EXCLUDE_DIRS = {
-    "venv",
-    ".venv",
-    "__pycache__",
-}  # Exclude common temporary or virtual environment folders
+EXCLUDE_DIRS = frozenset(
+    {
+        "venv",
+        ".venv",
+        "__pycache__",
+    }
+)  # Exclude common temporary or virtual environment folders
+
+# Step 7: Hashing settings
+# Hashes are tagged with the algorithm that made them, so BLAKE3 fingerprints
+# can never be confused with the SHA-256 ones stored by older versions.
+HASH_PREFIX = "b3:"
 
 
-# Step 7: Database connection pool management
+# Step 8: Database connection pool management
 @contextmanager
 def get_db_connection(pool: pool.SimpleConnectionPool):
     """
@@ -63,7 +84,7 @@ def get_db_connection(pool: pool.SimpleConnectionPool):
         pool.putconn(conn)  # Return the connection to the pool
 
 
-# Step 8: Detect USB devices and add them to the search list (optional feature)
+# Step 9: Detect USB devices and add them to the search list (optional feature)
 def detect_usb_devices() -> List[Path]:
     """
     Scans for USB devices or mounted drives and returns their paths.
@@ -77,7 +98,7 @@ def detect_usb_devices() -> List[Path]:
     return usb_dirs
 
 
-# Step 9: Initialize the database and ensure the necessary table exists
+# Step 10: Initialize the database and ensure the necessary table exists
 def initialize_database() -> pool.SimpleConnectionPool:
     """
     Sets up a connection pool and ensures the 'images' table exists in the database.
@@ -93,12 +114,21 @@ def initialize_database() -> pool.SimpleConnectionPool:
                     CREATE TABLE IF NOT EXISTS images (
                         id SERIAL PRIMARY KEY,
                         file_name TEXT,
-                        path TEXT UNIQUE,
+                        path TEXT,
                         extension TEXT,
                         size BIGINT,
                         timestamp BIGINT,
-                        hash TEXT UNIQUE
+                        hash TEXT UNIQUE  -- "b3:" + BLAKE3 hex digest
                     );
+                    -- Duplicates are detected by hash alone; a second unique
+                    -- index on path only slows down every insert
+                    ALTER TABLE images DROP CONSTRAINT IF EXISTS images_path_key;
+                    -- Filled in by thumbnail.py; needed here to clean up
+                    -- thumbnails of files whose contents changed
+                    ALTER TABLE images ADD COLUMN IF NOT EXISTS thumbnail_path TEXT;
+                    -- Also serves plain lookups by path
+                    CREATE INDEX IF NOT EXISTS idx_images_path_size_mtime
+                        ON images (path, size, timestamp);
                     """
                 )
                 conn.commit()
@@ -109,126 +139,328 @@ def initialize_database() -> pool.SimpleConnectionPool:
         raise
 
 
-# Step 10: Calculate a unique hash (fingerprint) for each file
+# Step 11: Calculate a unique hash (fingerprint) for each file
 def calculate_file_hash(file_path: Path) -> str:
     """
-    Reads a file and computes its SHA-256 hash for duplicate detection.
+    Computes the file's BLAKE3 hash for duplicate detection.
     """
-    sha256 = hashlib.sha256()  # Create a SHA-256 hash object
+    # BLAKE3 is much faster than SHA-256 and we only need a content fingerprint,
+    # not protection against deliberately crafted collisions.
+    # Single-threaded: catalog_images already hashes one file per CPU core
+    hasher = blake3()
     try:
-        with open(file_path, "rb") as f:  # Open the file in binary mode
-            for chunk in iter(
-                lambda: f.read(8192), b""
-            ):  # Read in chunks of 8192 bytes
-                sha256.update(chunk)
-        return sha256.hexdigest()  # Return the final hash as a string
+        hasher.update_mmap(str(file_path))  # Memory-map and hash the whole file
+        return HASH_PREFIX + hasher.hexdigest()  # Return the final hash as a string
     except Exception as e:
         logging.error(f"Failed to calculate hash for {file_path}: {e}")
         return ""
 
 
-# Step 11: Extract metadata for each file
-def process_file_metadata(file_path: Path) -> Optional[Dict]:
+# Step 12: Extract metadata for each file
+def process_file_metadata(file_info: Tuple[str, int, float, str]) -> Optional[Tuple]:
     """
-    Gathers metadata (name, path, size, timestamp, and hash) for a file.
+    Gathers metadata for a file as a (file_name, path, extension, size,
+    timestamp, hash) tuple, in the same order as the database columns.
+    Takes the (path, size, modification time, extension) found by
+    collect_files, so the file doesn't need to be looked up again.
     """
+    path_str, size, mtime, extension = file_info
+    file_path = Path(path_str)
     try:
-        if any(
-            part in EXCLUDE_DIRS for part in file_path.parts
-        ):  # Skip excluded folders
-            return None
-        file_stat = file_path.stat()  # Get file stats (size, modification time, etc.)
         file_hash = calculate_file_hash(file_path)  # Compute the file's hash
         if not file_hash:  # Skip files that couldn't be hashed
             return None
-        return {
-            "file_name": file_path.name,
-            "path": str(file_path.resolve()),
-            "extension": file_path.suffix.lower(),
-            "size": file_stat.st_size,
-            "timestamp": int(file_stat.st_mtime),
-            "hash": file_hash,
-        }
+        return (
+            file_path.name,  # file_name
+            os.path.abspath(path_str),  # path (no need to resolve symlinks)
+            extension,  # extension
+            size,  # size
+            int(mtime),  # timestamp
+            file_hash,  # hash
+        )
     except Exception as e:
         logging.error(f"Error processing {file_path}: {e}")
         return None
 
 
-# Step 12: Find all image files in the specified directories
-def collect_files(base_dirs: List[Path]) -> List[Path]:
+# Step 13: Find all image files in the specified directories
+def collect_files(base_dirs: List[Path]) -> List[Tuple[str, int, float, str]]:
     """
     Recursively searches for image files in the specified directories.
+    Uses os.scandir so file types come from the directory listing itself;
+    only image files are looked up, once, to get their size and modification
+    time. Returns (path, size, modification time, lowercase extension)
+    for each image.
     """
     all_files = []
     for base_dir in base_dirs:
-        if base_dir.exists():  # Ensure the directory exists
-            for file_path in base_dir.rglob("*"):  # Recursively search for files
-                if (
-                    file_path.is_file()
-                    and file_path.suffix.lower() in IMAGE_EXTENSIONS
-                    and not file_path.name.startswith(".")  # Skip hidden files
-                    and not any(part in EXCLUDE_DIRS for part in file_path.parts)
-                ):
-                    all_files.append(file_path)
+        if not base_dir.exists():  # Ensure the directory exists
+            continue
+        pending_dirs = deque([str(base_dir)])
+        while pending_dirs:
+            current_dir = pending_dirs.pop()
+            try:
+                with os.scandir(current_dir) as entries:
+                    for entry in entries:
+                        name = entry.name
+                        # Symlinked folders aren't entered (they could loop back)
+                        if entry.is_dir(follow_symlinks=False):
+                            if name not in EXCLUDE_DIRS:  # Skip excluded folders
+                                pending_dirs.append(entry.path)
+                            continue
+                        # Symlinked image files are followed, like before
+                        if name[0] == "." or not entry.is_file():
+                            continue  # Skip hidden files and special files
+                        dot = name.rfind(".")
+                        extension = name[dot:].lower()  # e.g. ".jpg"
+                        if dot != -1 and extension in IMAGE_EXTENSIONS:
+                            file_stat = entry.stat()  # The target's size and time
+                            all_files.append(
+                                (
+                                    entry.path,
+                                    file_stat.st_size,
+                                    file_stat.st_mtime,
+                                    extension,
+                                )
+                            )
+            except OSError as e:  # e.g. a folder we aren't allowed to read
+                logging.warning(f"Could not scan {current_dir}: {e}")
     logging.info(f"Collected {len(all_files)} files to process.")
     return all_files
 
 
-# Step 13: Insert metadata into the database in batches
-def insert_image_records(conn, records: List[Dict]) -> int:
+# Step 14: Insert metadata into the database in batches
+# Batches smaller than this are sent with a plain INSERT; bigger ones use COPY.
+COPY_MIN_BATCH = 100
+
+
+def escape_copy_value(value) -> str:
+    """
+    Formats a value for PostgreSQL's text COPY format.
+    """
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def insert_image_records(
+    conn, records: List[Tuple], stale_thumbnails: Optional[List[str]] = None
+) -> int:
     """
-    Inserts a batch of image metadata records into the database.
+    Inserts a batch of image metadata records (tuples from
+    process_file_metadata) into the database.
+    If a file's contents changed, its old row is deleted and the old row's
+    thumbnail path is added to 'stale_thumbnails'. If only its size or
+    modification time changed, the existing row is updated in place.
+    The caller is responsible for committing. Large batches are streamed
+    with COPY into a temporary staging table and then moved into 'images',
+    skipping copies of files that are already cataloged.
     """
     if not records:
         return 0
-    query = """
-        INSERT INTO images (file_name, path, extension, size, timestamp, hash)
-        VALUES %s
-        ON CONFLICT (hash) DO NOTHING;
-    """
-    values = [
-        (
-            record["file_name"],
-            record["path"],
-            record["extension"],
-            record["size"],
-            record["timestamp"],
-            record["hash"],
-        )
-        for record in records
-    ]
+    # ON CONFLICT DO UPDATE can't change the same row twice in one statement,
+    # so keep only the first file with each hash in this batch
+    by_hash = {}
+    for record in records:
+        by_hash.setdefault(record[5], record)
+    records = list(by_hash.values())
     with conn.cursor() as cursor:
-        psycopg2.extras.execute_values(cursor, query, values, page_size=1000)
-        inserted = cursor.rowcount  # Count how many records were inserted
-        conn.commit()
-        logging.info(f"Inserted {inserted} records.")
+        # Remove rows describing the old contents of files that changed
+        cursor.execute(
+            """
+            DELETE FROM images AS i
+            USING unnest(%s::text[], %s::text[]) AS v(path, hash)
+            WHERE i.path = v.path AND i.hash <> v.hash
+            RETURNING i.thumbnail_path
+            """,
+            ([record[1] for record in records], [record[5] for record in records]),
+        )
+        if stale_thumbnails is not None:
+            stale_thumbnails.extend(path for (path,) in cursor if path)
+        if len(records) < COPY_MIN_BATCH:  # Not worth the staging table
+            query = """
+                INSERT INTO images (file_name, path, extension, size, timestamp, hash)
+                VALUES %s
+                ON CONFLICT (hash) DO UPDATE
+                SET size = EXCLUDED.size, timestamp = EXCLUDED.timestamp
+                WHERE images.path = EXCLUDED.path;
+            """
+            psycopg2.extras.execute_values(
+                cursor,
+                query,
+                records,
+                template="(%s, %s, %s, %s, %s, %s)",
+                page_size=1000,
+            )
+        else:
+            # Temporary tables are never written to the WAL and are private
+            # to this connection, so the staging table is cheap to fill.
+            cursor.execute(
+                """
+                CREATE TEMP TABLE IF NOT EXISTS images_staging (
+                    file_name TEXT,
+                    path TEXT,
+                    extension TEXT,
+                    size BIGINT,
+                    timestamp BIGINT,
+                    hash TEXT
+                );
+                TRUNCATE images_staging;
+                """
+            )
+            buffer = io.StringIO()
+            for row in records:
+                buffer.write("\t".join(escape_copy_value(v) for v in row) + "\n")
+            buffer.seek(0)
+            cursor.copy_expert(
+                """
+                COPY images_staging (file_name, path, extension, size, timestamp, hash)
+                FROM STDIN
+                """,
+                buffer,
+            )
+            cursor.execute(
+                """
+                INSERT INTO images (file_name, path, extension, size, timestamp, hash)
+                SELECT file_name, path, extension, size, timestamp, hash
+                FROM images_staging
+                ON CONFLICT (hash) DO UPDATE
+                SET size = EXCLUDED.size, timestamp = EXCLUDED.timestamp
+                WHERE images.path = EXCLUDED.path;
+                """
+            )
+        inserted = cursor.rowcount  # Count how many records were inserted or updated
+        logging.info(f"Inserted or updated {inserted} records.")
         return inserted
 
 
-# Step 14: Catalog all images and store their metadata in the database
+# Step 15: Catalog all images and store their metadata in the database
+# Commit after this many batches, so we don't pay for a disk flush every batch
+COMMIT_EVERY_BATCHES = 10
+
+
+def remove_thumbnails(thumbnail_paths: List[str]):
+    """
+    Deletes thumbnail files whose database rows were removed.
+    Paths are as thumbnail.py stored them, so this works when both scripts
+    run from the same folder; files that can't be found are left alone.
+    """
+    for thumbnail_path in thumbnail_paths:
+        try:
+            os.remove(thumbnail_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Could not remove old thumbnail {thumbnail_path}: {e}")
+
+
+def write_image_records(conn, record_queue: queue.Queue, batch_size: int, errors: List):
+    """
+    Runs in a background thread: takes records off the queue and inserts them
+    in batches until it receives None. Any database error is added to 'errors'.
+    """
+    records = []  # To store metadata
+    uncommitted = 0  # Records inserted since the last commit
+    stale_thumbnails = []  # Thumbnails to delete once their rows are committed
+    finished = False  # Set once the end-of-work signal (None) has arrived
+    try:
+        while True:
+            record = record_queue.get()
+            if record is None:  # No more records are coming
+                finished = True
+                break
+            records.append(record)
+            if len(records) >= batch_size:  # Insert records in batches
+                insert_image_records(conn, records, stale_thumbnails)
+                uncommitted += len(records)
+                records = []
+                if uncommitted >= COMMIT_EVERY_BATCHES * batch_size:
+                    conn.commit()  # Save progress every few batches
+                    uncommitted = 0
+                    remove_thumbnails(stale_thumbnails)
+                    stale_thumbnails = []
+        if records:  # Insert any remaining records
+            insert_image_records(conn, records, stale_thumbnails)
+        conn.commit()  # Save everything that's left
+        remove_thumbnails(stale_thumbnails)
+    except Exception as e:
+        errors.append(e)
+        try:
+            conn.rollback()
+        except Exception as rollback_error:  # e.g. the connection was lost
+            logging.error(f"Rollback failed: {rollback_error}")
+    finally:
+        # Keep emptying the queue so the hashing loop never gets stuck waiting
+        while not finished:
+            finished = record_queue.get() is None
+
+
 def catalog_images(conn_pool, base_dirs: List[Path], batch_size=500):
     """
     Scans for image files, extracts metadata, and saves it to the database.
+    Files are hashed by worker processes while a background thread inserts
+    the results, so hashing and database writes happen at the same time.
     """
     all_files = collect_files(base_dirs)  # Find all image files
-    records = []  # To store metadata
+    # Only this (main) process talks to the database; the worker processes
+    # just read and hash files and send the metadata back.
     with get_db_connection(conn_pool) as conn:
-        with tqdm(
-            total=len(all_files), desc="Cataloging files"
-        ) as pbar:  # Show a progress bar
-            for file_path in all_files:
-                record = process_file_metadata(file_path)
-                if record:
-                    records.append(record)
-                    if len(records) >= batch_size:  # Insert records in batches
-                        insert_image_records(conn, records)
-                        records = []
-                pbar.update(1)
-            if records:  # Insert any remaining records
-                insert_image_records(conn, records)
-
-
-# Step 15: Parse command-line arguments for user interaction
+        conn.autocommit = False  # Group many batches into one transaction
+        with conn.cursor() as cursor:
+            # Don't wait for each commit to reach the disk. If the database
+            # crashes, the last few seconds of inserts can be lost, but the
+            # next catalog run simply adds them again. Only affects this session.
+            cursor.execute("SET synchronous_commit = OFF")
+
+        # Files whose path, size and modification time are already in the
+        # database haven't changed since the last run, so don't hash them again.
+        # Rows are read oldest first, so the newest row for each path wins.
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT path, size, timestamp FROM images ORDER BY id")
+            known = {path: (size, timestamp) for path, size, timestamp in cursor}
+        new_files = [
+            file_info
+            for file_info in all_files
+            if known.get(os.path.abspath(file_info[0]))
+            != (file_info[1], int(file_info[2]))
+        ]
+        del known  # Free the memory before hashing starts
+        logging.info(
+            f"Skipping {len(all_files) - len(new_files)} files already cataloged."
+        )
+
+        # From here on, only the writer thread uses the connection
+        record_queue = queue.Queue(maxsize=4 * batch_size)
+        errors = []
+        writer = threading.Thread(
+            target=write_image_records,
+            args=(conn, record_queue, batch_size, errors),
+            name="image-record-writer",
+        )
+        writer.start()
+        try:
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+                results = executor.map(process_file_metadata, new_files, chunksize=64)
+                for record in tqdm(
+                    results, total=len(new_files), desc="Cataloging files"
+                ):  # Show a progress bar
+                    if errors:  # The writer failed, so stop hashing files
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        break
+                    if record:
+                        record_queue.put(record)
+        finally:
+            record_queue.put(None)  # Tell the writer thread we're done
+            writer.join()
+        if errors:
+            raise errors[0]
+
+
+# Step 16: Parse command-line arguments for user interaction
 def parse_arguments():
     """
     Sets up the command-line interface for the script.
@@ -245,7 +477,7 @@ def parse_arguments():
     return parser.parse_args()
 
 
-# Step 16: Main entry point for the script
+# Step 17: Main entry point for the script
 def main():
     args = parse_arguments()
     SEARCH_DIRS.extend(detect_usb_devices())  # Add USB devices to the search